@@ -1,147 +1,273 @@
+import copy
 import streamlit as st
-import openai
-from openai import OpenAI
-import re
+from medbot_core import ReplyCache, SentinelFilter, format_conversation, messages_over_budget, throttle
 
 # Set up the page with wide layout for two columns
 st.set_page_config(page_title="LinQMD Medical Intake Assistant", page_icon="🏥", layout="wide")
 st.title("🏥 LinQMD Medical Intake Assistant")
 
-# Initialize OpenAI client
+# OpenAI Playground prompt that holds the intake instructions
+INTAKE_PROMPT = {
+    "id": "pmpt_6890c2093c388190a66ef880c473a00203ff24f87032e5f6",
+    "version": "4"
+}
+
+# Only the most recent messages are sent verbatim; once the conversation grows
+# past the threshold, older turns are folded into a short synopsis that is
+# refreshed after every few newly dropped messages
+HISTORY_WINDOW = 8
+HISTORY_SUMMARY_THRESHOLD = 12
+HISTORY_SUMMARY_REFRESH = 4
+HISTORY_SUMMARY_MODEL = "gpt-4o-mini"
+HISTORY_SUMMARY_TOKENS = 300
+
+# Character budget for the verbatim part of the context, roughly 3000 tokens
+# at ~4 characters per token; whole messages past it are folded into the
+# synopsis early, oldest first
+MAX_CONTEXT_CHARS = 12000
+
+# Number of most recent messages always rendered in the chat; older ones are
+# only drawn when the patient asks to see them
+RECENT_MESSAGES = 50
+
+# Initialize OpenAI client; the SDK is imported here so page load does not pay
+# for it, and the cached resource means the import happens once per process.
+# Idle connections are kept well past httpx's 5 second default so the next
+# chat turn, from any session, reuses a warm TLS connection.
 @st.cache_resource
 def get_openai_client():
-    return OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+    import httpx
+    from openai import DEFAULT_CONNECTION_LIMITS, DefaultHttpxClient, OpenAI
+    return OpenAI(
+        api_key=st.secrets["OPENAI_API_KEY"],
+        http_client=DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=DEFAULT_CONNECTION_LIMITS.max_connections,
+                max_keepalive_connections=DEFAULT_CONNECTION_LIMITS.max_keepalive_connections,
+                keepalive_expiry=300.0
+            )
+        )
+    )
+
+# Opening messages whose reply can be shared across sessions; any real
+# consultation content always gets a fresh reply
+CACHEABLE_OPENINGS = {"hi", "hello", "hey", "done"}
+
+# Complete replies shared across sessions, keyed by the exact request
+@st.cache_resource
+def get_reply_cache():
+    return ReplyCache()
+
+# Sidebar instructions, sent as a single element
+INSTRUCTIONS_MD = """
+1. Patient describes symptoms in the chat
+2. Assistant asks follow-up questions
+3. Patient types 'done' when finished
+4. Summaries appear automatically
+"""
+
+# Per-consultation session state and its initial values
+SESSION_DEFAULTS = {
+    "messages": [],
+    "patient_summary": "",
+    "clinical_summary": "",
+    "history_summary": "",
+    "history_summary_upto": 0,
+}
 
 # Initialize session state
-if "messages" not in st.session_state:
-    st.session_state.messages = []
-if "patient_summary" not in st.session_state:
-    st.session_state.patient_summary = ""
-if "clinical_summary" not in st.session_state:
-    st.session_state.clinical_summary = ""
-
-# Function to extract summaries from text
-def extract_summaries(text):
-    display_text = text
-    patient_summary = ""
-    clinical_summary = ""
-    
-    # Extract patient summary
-    if "---BEGIN_PATIENT_SUMMARY---" in text:
-        patient_match = re.search(
-            r'---BEGIN_PATIENT_SUMMARY---(.*?)---END_PATIENT_SUMMARY---', 
-            text, re.DOTALL
-        )
-        if patient_match:
-            patient_summary = patient_match.group(1).strip()
-            display_text = display_text.replace(patient_match.group(0), "")
-    
-    # Extract clinical summary
-    if "---BEGIN_CLINICAL_SUMMARY_CONFIDENTIAL---" in text:
-        clinical_match = re.search(
-            r'---BEGIN_CLINICAL_SUMMARY_CONFIDENTIAL---(.*?)---END_CLINICAL_SUMMARY_CONFIDENTIAL---', 
-            text, re.DOTALL
+for key, default in SESSION_DEFAULTS.items():
+    if key not in st.session_state:
+        st.session_state[key] = copy.copy(default)
+
+# Fold messages that fell out of the window, or that do not fit in the
+# context budget, into the running synopsis
+def refresh_history_summary(client, messages):
+    covered = st.session_state.history_summary_upto
+    cutoff = covered
+    if (
+        len(messages) > HISTORY_SUMMARY_THRESHOLD
+        and len(messages) - HISTORY_WINDOW - covered >= HISTORY_SUMMARY_REFRESH
+    ):
+        cutoff = len(messages) - HISTORY_WINDOW
+    cutoff += messages_over_budget(messages[cutoff:], MAX_CONTEXT_CHARS)
+    if cutoff == covered:
+        return
+    
+    with st.spinner("Processing..."):
+        response = client.responses.create(
+            model=HISTORY_SUMMARY_MODEL,
+            instructions=(
+                "Condense this medical intake conversation into a brief synopsis. "
+                "Keep every clinically relevant fact: symptoms, onset, duration, "
+                "severity, medical history, medications, allergies and red flags."
+            ),
+            input=(
+                f"Synopsis so far:\n{st.session_state.history_summary}\n\n"
+                f"New turns:\n{format_conversation(messages[covered:cutoff])}"
+            ),
+            max_output_tokens=HISTORY_SUMMARY_TOKENS
         )
-        if clinical_match:
-            clinical_summary = clinical_match.group(1).strip()
-            display_text = display_text.replace(clinical_match.group(0), "")
+    st.session_state.history_summary = response.output_text
+    st.session_state.history_summary_upto = cutoff
+
+# Stream a reply into the placeholder and return its
+# (display_text, patient_summary, clinical_summary) and whether it completed
+def stream_reply(client, conversation_context, placeholder):
+    # Yield the text deltas from the event stream; summary blocks are
+    # routed to their own buffers so they never flash up in the chat
+    sentinel_filter = SentinelFilter()
+    status = None
+    
+    def token_iter(stream):
+        nonlocal status
+        for event in stream:
+            if event.type == "response.output_text.delta":
+                visible = sentinel_filter.feed(event.delta)
+                if visible:
+                    yield visible
+            elif event.type in ("response.completed", "response.incomplete"):
+                status = event.response.status
+        yield sentinel_filter.flush()
     
-    return display_text.strip(), patient_summary, clinical_summary
+    # Tokens are rendered as plain text at a bounded update rate;
+    # markdown is only parsed once the reply is complete
+    shown = []
+    
+    # Using your OpenAI Playground prompt with the conversation context,
+    # streamed so tokens render as soon as they are generated. The
+    # context manager closes the connection even when a new chat
+    # input interrupts this run mid-stream.
+    with client.responses.create(
+        prompt=INTAKE_PROMPT,
+        input=conversation_context,
+        stream=True
+    ) as stream:
+        for piece in throttle(token_iter(stream)):
+            shown.append(piece)
+            placeholder.text("".join(shown))
+    
+    # Also report whether the reply ran to completion; one cut off mid-way
+    # must not pass for a complete one
+    complete = status == "completed" and not sentinel_filter.truncated
+    return sentinel_filter.result(), complete
 
-# Create two columns
-col1, col2 = st.columns([1.2, 1])
+# Display messages, one chat bubble each
+def render_messages(messages):
+    for message in messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
 
-# Left Column - Patient Chat
-with col1:
-    st.subheader("💬 Patient Consultation")
-    
+# Patient chat as a fragment, so a chat turn reruns only this panel
+@st.fragment
+def render_chat():
     # Create a container for chat messages
     chat_container = st.container(height=500)
+    messages = st.session_state.messages
     
-    with chat_container:
-        # Display chat history
-        for message in st.session_state.messages:
-            with st.chat_message(message["role"]):
-                # For assistant messages, only show the display text (not summaries)
-                if message["role"] == "assistant":
-                    display_text, _, _ = extract_summaries(message["content"])
-                    st.markdown(display_text)
-                else:
-                    st.markdown(message["content"])
-    
-    # Chat input
+    # Chat input, read before the history is drawn so the history shows the
+    # patient turn exactly as it is sent
     if prompt := st.chat_input("Describe your symptoms (type 'done' when finished)..."):
-        # Add user message to chat history
-        st.session_state.messages.append({"role": "user", "content": prompt})
-        
-        # Display user message
-        with chat_container:
-            with st.chat_message("user"):
-                st.markdown(prompt)
-        
+        # Add user message to chat history. A message sent while the previous
+        # one is still unanswered (its run was interrupted) is folded into it,
+        # so queued turns go to the model as a single request. Failed turns
+        # are removed below, so only interrupted ones are left unanswered.
+        if messages and messages[-1]["role"] == "user":
+            messages[-1]["content"] += f"\n\n{prompt}"
+        else:
+            messages.append({"role": "user", "content": prompt})
+    
+    with chat_container:
+        # Display chat history; on long consultations the older part is only
+        # rendered on request instead of on every rerun
+        older = messages[:-RECENT_MESSAGES]
+        if older and st.toggle(f"Show {len(older)} earlier messages", key="show_earlier"):
+            # Drawn without a bubble per message; each message stays its own
+            # markdown element so its formatting cannot spill into the next
+            for m in older:
+                st.markdown(f"**{'🧑' if m['role'] == 'user' else '🤖'}** {m['content']}")
+        render_messages(messages[-RECENT_MESSAGES:])
+    
+    if prompt:
         # Generate bot response
         with chat_container:
             with st.chat_message("assistant"):
-                with st.spinner("Processing..."):
-                    try:
-                        client = get_openai_client()
-                        
-                        # Build conversation history for the prompt
-                        conversation_context = ""
-                        for msg in st.session_state.messages[:-1]:  # Exclude the last message we just added
-                            if msg["role"] == "user":
-                                conversation_context += f"Patient: {msg['content']}\n"
-                            else:
-                                conversation_context += f"Assistant: {msg['content']}\n"
-                        
-                        # Add the current message
-                        conversation_context += f"Patient: {prompt}\n"
-                        
-                        # Using your OpenAI Playground prompt with full conversation context
-                        response = client.responses.create(
-                            prompt={
-                                "id": "pmpt_6890c2093c388190a66ef880c473a00203ff24f87032e5f6",
-                                "version": "4"
-                            },
-                            # Pass the full conversation context
-                            input=conversation_context
+                try:
+                    client = get_openai_client()
+                    
+                    # Build conversation history for the prompt: the synopsis of
+                    # older turns followed by the recent messages verbatim
+                    refresh_history_summary(client, st.session_state.messages)
+                    conversation_context = ""
+                    if st.session_state.history_summary:
+                        conversation_context += f"Conversation so far: {st.session_state.history_summary}\n"
+                    conversation_context += format_conversation(
+                        st.session_state.messages[st.session_state.history_summary_upto:]
+                    )
+                    
+                    # A canned opening message is answered from the shared reply
+                    # cache; everything else is streamed from the API
+                    placeholder = st.empty()
+                    cacheable = (
+                        len(messages) == 1
+                        and messages[0]["content"].strip(" !.?").lower() in CACHEABLE_OPENINGS
+                    )
+                    reply = None
+                    complete = True
+                    if cacheable:
+                        reply_cache = get_reply_cache()
+                        cache_key = reply_cache.key(INTAKE_PROMPT["id"], INTAKE_PROMPT["version"], conversation_context)
+                        reply = reply_cache.get(cache_key)
+                    if reply is None:
+                        reply, complete = stream_reply(client, conversation_context, placeholder)
+                        if cacheable and complete and any(reply):
+                            reply_cache.put(cache_key, reply)
+                    
+                    # The summaries were split out while streaming
+                    display_text, patient_sum, clinical_sum = reply
+                    if not any(reply):
+                        display_text = "No output in response"
+                    
+                    # A reply cut off mid-way is kept as it arrived, with a warning
+                    # that stays on it in the history
+                    if not complete:
+                        display_text += (
+                            "\n\n⚠️ *This reply was cut off before it finished, so part of it "
+                            "may be missing. Send 'continue' to pick up where it stopped.*"
                         )
-                        
-                        # Extract the bot response from the output array
-                        if hasattr(response, 'output') and len(response.output) > 0:
-                            output_message = response.output[0]
-                            if hasattr(output_message, 'content') and len(output_message.content) > 0:
-                                content_item = output_message.content[0]
-                                if hasattr(content_item, 'text'):
-                                    bot_response = content_item.text
-                                else:
-                                    bot_response = str(content_item)
-                            else:
-                                bot_response = "No content in output message"
-                        else:
-                            bot_response = "No output in response"
-                        
-                        # Extract summaries if present
-                        display_text, patient_sum, clinical_sum = extract_summaries(bot_response)
-                        
-                        # Display only the conversation part (not summaries)
-                        st.markdown(display_text)
-                        
-                        # Update summaries in session state if found
-                        if patient_sum:
-                            st.session_state.patient_summary = patient_sum
-                        if clinical_sum:
-                            st.session_state.clinical_summary = clinical_sum
-                        
-                        # Add full bot response to chat history
-                        st.session_state.messages.append({"role": "assistant", "content": bot_response})
-                        
-                        # Rerun to update the right column
+                    placeholder.markdown(display_text)
+                    
+                    # Update summaries in session state if found
+                    if patient_sum:
+                        st.session_state.patient_summary = patient_sum
+                    if clinical_sum:
+                        st.session_state.clinical_summary = clinical_sum
+                    
+                    # Add only the display text to chat history; the summaries
+                    # already live in their own session state slots
+                    st.session_state.messages.append({"role": "assistant", "content": display_text})
+                    
+                    # The reply is already on screen; only a new summary needs a
+                    # full rerun to reach the summary panels
+                    if patient_sum or clinical_sum:
                         st.rerun()
-                        
-                    except Exception as e:
-                        st.error(f"Error: {str(e)}")
-                        st.info("Please check your API key and try again.")
+                    
+                except Exception as e:
+                    # Drop the unanswered turn so a retyped message is not
+                    # merged with the one that failed
+                    if st.session_state.messages and st.session_state.messages[-1]["role"] == "user":
+                        st.session_state.messages.pop()
+                    st.error(f"Error: {str(e)}")
+                    st.info("Your message was not sent. Please check your API key and try again.")
+
+# Create two columns
+col1, col2 = st.columns([1.2, 1])
+
+# Left Column - Patient Chat
+with col1:
+    st.subheader("💬 Patient Consultation")
+    
+    render_chat()
     
     # Show patient summary if available
     if st.session_state.patient_summary:
@@ -178,18 +304,15 @@ with st.sidebar:
     st.header("⚙️ Controls")
     
     if st.button("🔄 Start New Consultation", type="primary"):
-        st.session_state.messages = []
-        st.session_state.patient_summary = ""
-        st.session_state.clinical_summary = ""
+        # Drop only the consultation keys; the rerun re-initializes them
+        for key in SESSION_DEFAULTS:
+            st.session_state.pop(key, None)
         st.rerun()
     
     st.markdown("---")
     
     st.header("📖 Instructions")
-    st.write("1. Patient describes symptoms in the chat")
-    st.write("2. Assistant asks follow-up questions")
-    st.write("3. Patient types 'done' when finished")
-    st.write("4. Summaries appear automatically")
+    st.markdown(INSTRUCTIONS_MD)
     
     st.markdown("---")
     
@@ -0,0 +1,163 @@
+# Streamlit-free helpers for the intake chat: transcript formatting, splitting
+# summaries out of streamed replies, stream throttling and reply caching
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# Summary delimiters
+PATIENT_BEGIN = "---BEGIN_PATIENT_SUMMARY---"
+PATIENT_END = "---END_PATIENT_SUMMARY---"
+CLINICAL_BEGIN = "---BEGIN_CLINICAL_SUMMARY_CONFIDENTIAL---"
+CLINICAL_END = "---END_CLINICAL_SUMMARY_CONFIDENTIAL---"
+
+# Format messages as the Patient/Assistant transcript the prompt expects
+def format_conversation(messages):
+    return "".join(
+        f"{'Patient' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}\n"
+        for msg in messages
+    )
+
+# Number of oldest messages to drop so the formatted transcript of the rest
+# fits in max_chars; messages are dropped whole and the last one, the current
+# turn, is always kept even if it alone is over budget
+def messages_over_budget(messages, max_chars):
+    total = len(format_conversation(messages))
+    dropped = 0
+    while total > max_chars and dropped < len(messages) - 1:
+        total -= len(format_conversation(messages[dropped:dropped + 1]))
+        dropped += 1
+    return dropped
+
+# Streaming state machine that splits a reply into display text and summaries
+# as it arrives: text inside a summary block is routed to that summary and
+# never reaches the display
+class SentinelFilter:
+    SENTINELS = {PATIENT_BEGIN: PATIENT_END, CLINICAL_BEGIN: CLINICAL_END}
+    _lookback = max(len(begin) for begin in SENTINELS) - 1
+    
+    def __init__(self):
+        self._tail = ""       # text not yet routed
+        self._begin = None    # BEGIN sentinel of the summary block being read
+        self._display = []    # text released to the display
+        self._block = []      # text of the summary block being read
+        self._summaries = {}  # BEGIN sentinel -> summary text
+    
+    # Length of the longest suffix of the tail that could start a BEGIN sentinel
+    def _partial_len(self):
+        for size in range(min(len(self._tail), self._lookback), 0, -1):
+            suffix = self._tail[-size:]
+            if any(begin.startswith(suffix) for begin in self.SENTINELS):
+                return size
+        return 0
+    
+    # Consume a streamed delta and return the text that is safe to display
+    def feed(self, delta):
+        self._tail += delta
+        visible = []
+        while True:
+            if self._begin is None:
+                hits = [(self._tail.find(begin), begin) for begin in self.SENTINELS]
+                hits = [hit for hit in hits if hit[0] != -1]
+                if hits:
+                    start, begin = min(hits)
+                    visible.append(self._tail[:start])
+                    self._tail = self._tail[start + len(begin):]
+                    self._begin = begin
+                    continue
+                keep = self._partial_len()
+                visible.append(self._tail[:len(self._tail) - keep])
+                self._tail = self._tail[len(self._tail) - keep:]
+            else:
+                end = self.SENTINELS[self._begin]
+                stop = self._tail.find(end)
+                if stop != -1:
+                    self._block.append(self._tail[:stop])
+                    # The first block of each kind wins
+                    self._summaries.setdefault(self._begin, "".join(self._block).strip())
+                    self._block = []
+                    self._tail = self._tail[stop + len(end):]
+                    self._begin = None
+                    continue
+                # Route the block text, keeping only a possible partial END sentinel
+                keep = len(end) - 1
+                self._block.append(self._tail[:-keep])
+                self._tail = self._tail[-keep:]
+            text = "".join(visible)
+            self._display.append(text)
+            return text
+    
+    # Release whatever displayable text is left once the stream ends; an
+    # unterminated summary block is dropped rather than shown, and flagged
+    # through truncated
+    def flush(self):
+        rest = "" if self._begin else self._tail
+        self._display.append(rest)
+        self._tail = ""
+        return rest
+    
+    # True when the reply ended inside a summary block
+    @property
+    def truncated(self):
+        return self._begin is not None
+    
+    # Display text, patient summary and clinical summary of the flushed reply
+    def result(self):
+        return (
+            "".join(self._display).strip(),
+            self._summaries.get(PATIENT_BEGIN, ""),
+            self._summaries.get(CLINICAL_BEGIN, ""),
+        )
+
+# Coalesce streamed text so the UI updates at most every interval seconds,
+# and only once at least min_chars are pending
+def throttle(pieces, interval=0.05, min_chars=8):
+    buffer = []
+    pending = 0
+    last_flush = time.monotonic()
+    for piece in pieces:
+        buffer.append(piece)
+        pending += len(piece)
+        now = time.monotonic()
+        if pending >= min_chars and now - last_flush >= interval:
+            yield "".join(buffer)
+            buffer.clear()
+            pending = 0
+            last_flush = now
+    if buffer:
+        yield "".join(buffer)
+
+# Thread-safe LRU of complete replies with a time-to-live; a single instance is
+# shared by all sessions, so an exact repeat of a request skips the API
+class ReplyCache:
+    def __init__(self, max_entries=256, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (stored_at, reply)
+        self._lock = threading.Lock()
+    
+    # Build a compact key from the parts that determine a reply
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+    
+    # Return the cached reply, or None when missing or expired
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, reply = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return reply
+    
+    def put(self, key, reply):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), reply)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
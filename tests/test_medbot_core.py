@@ -0,0 +1,195 @@
+import random
+import re
+import unittest
+from unittest import mock
+
+from medbot_core import ReplyCache, SentinelFilter, format_conversation, messages_over_budget, throttle
+
+# Stand-in for time.monotonic that only moves when a test advances it
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+# Yield each piece after advancing the clock by its delay, as a stream would
+def timed_pieces(clock, pieces):
+    for delay, piece in pieces:
+        clock.now += delay
+        yield piece
+
+class ThrottleTest(unittest.TestCase):
+    def run_throttle(self, pieces):
+        clock = FakeClock()
+        with mock.patch("medbot_core.time.monotonic", clock):
+            return list(throttle(timed_pieces(clock, pieces)))
+
+    def test_coalesces_pieces_within_the_interval(self):
+        self.assertEqual(self.run_throttle([(0.01, "abcd")] * 4), ["abcd" * 4])
+
+    def test_flushes_once_interval_and_min_chars_are_met(self):
+        pieces = [(0.1, "abcdefgh"), (0.01, "ijklmnop"), (0.1, "q")]
+        self.assertEqual(self.run_throttle(pieces), ["abcdefgh", "ijklmnopq"])
+
+    def test_short_pieces_wait_for_min_chars(self):
+        self.assertEqual(self.run_throttle([(1.0, "ab")] * 3), ["ababab"])
+
+    def test_remainder_is_flushed_at_the_end(self):
+        self.assertEqual(self.run_throttle([(0.1, "abcdefgh"), (0.1, "ij")]), ["abcdefgh", "ij"])
+        self.assertEqual(self.run_throttle([]), [])
+
+class ReplyCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch("medbot_core.time.monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_key_keeps_parts_apart(self):
+        self.assertEqual(ReplyCache.key("a", "b"), ReplyCache.key("a", "b"))
+        self.assertNotEqual(ReplyCache.key("ab", "c"), ReplyCache.key("a", "bc"))
+
+    def test_entries_expire_after_ttl(self):
+        cache = ReplyCache(ttl=10)
+        cache.put("k", "reply")
+        self.clock.now = 10
+        self.assertEqual(cache.get("k"), "reply")
+        self.clock.now = 10.5
+        self.assertIsNone(cache.get("k"))
+        self.clock.now = 0
+        self.assertIsNone(cache.get("k"))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = ReplyCache(max_entries=2)
+        for key in ("a", "b", "c"):
+            cache.put(key, key.upper())
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual((cache.get("b"), cache.get("c")), ("B", "C"))
+
+    def test_get_marks_entry_most_recent(self):
+        cache = ReplyCache(max_entries=2)
+        cache.put("a", "A")
+        cache.put("b", "B")
+        cache.get("a")
+        cache.put("c", "C")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.get("a"), cache.get("c")), ("A", "C"))
+
+    def test_put_again_marks_entry_most_recent(self):
+        cache = ReplyCache(max_entries=2)
+        cache.put("a", "A")
+        cache.put("b", "B")
+        cache.put("a", "A2")
+        cache.put("c", "C")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.get("a"), cache.get("c")), ("A2", "C"))
+
+# The regex extraction SentinelFilter replaced; it is the reference for what the
+# patient may see and what goes to each summary
+_PATIENT_RE = re.compile(r"---BEGIN_PATIENT_SUMMARY---(.*?)---END_PATIENT_SUMMARY---", re.DOTALL)
+_CLINICAL_RE = re.compile(
+    r"---BEGIN_CLINICAL_SUMMARY_CONFIDENTIAL---(.*?)---END_CLINICAL_SUMMARY_CONFIDENTIAL---", re.DOTALL
+)
+
+def reference_extract(text):
+    display_text = text
+    patient_summary = ""
+    clinical_summary = ""
+    patient_match = _PATIENT_RE.search(text)
+    if patient_match:
+        patient_summary = patient_match.group(1).strip()
+        display_text = display_text.replace(patient_match.group(0), "")
+    clinical_match = _CLINICAL_RE.search(text)
+    if clinical_match:
+        clinical_summary = clinical_match.group(1).strip()
+        display_text = display_text.replace(clinical_match.group(0), "")
+    return display_text.strip(), patient_summary, clinical_summary
+
+PATIENT = "---BEGIN_PATIENT_SUMMARY---\nYou reported chest pain.\n---END_PATIENT_SUMMARY---"
+CLINICAL = (
+    "---BEGIN_CLINICAL_SUMMARY_CONFIDENTIAL---\n"
+    "CC: chest pain - 2 days; Meds: metformin --- RED FLAG\n"
+    "---END_CLINICAL_SUMMARY_CONFIDENTIAL---"
+)
+REPLIES = [
+    "",
+    "How long have you had the pain?",
+    "Dashes --- and - and ---BEGIN_ but no block ---",
+    "Thank you.\n\n" + PATIENT + "\n\nTake care --\n" + CLINICAL + "\nEnd ---",
+    CLINICAL + PATIENT,
+    "Before " + CLINICAL + " after",
+]
+
+# Split text into random chunks, as a stream of deltas would arrive
+def random_chunks(rng, text):
+    chunks = []
+    i = 0
+    while i < len(text):
+        size = rng.randint(1, 12)
+        chunks.append(text[i:i + size])
+        i += size
+    return chunks
+
+def run_filter(chunks):
+    sentinel_filter = SentinelFilter()
+    shown = [sentinel_filter.feed(chunk) for chunk in chunks]
+    shown.append(sentinel_filter.flush())
+    return "".join(shown), sentinel_filter
+
+class SentinelFilterTest(unittest.TestCase):
+    def test_matches_reference_extraction_for_any_chunking(self):
+        rng = random.Random(1234)
+        for reply in REPLIES:
+            expected = reference_extract(reply)
+            for _ in range(300):
+                shown, sentinel_filter = run_filter(random_chunks(rng, reply))
+                self.assertEqual(sentinel_filter.result(), expected)
+                self.assertEqual(shown.strip(), expected[0])
+                self.assertFalse(sentinel_filter.truncated)
+
+    def test_confidential_text_never_streams_to_display(self):
+        rng = random.Random(99)
+        reply = "Thanks.\n" + CLINICAL + "\nBye"
+        for _ in range(300):
+            shown, _ = run_filter(random_chunks(rng, reply))
+            self.assertNotIn("metformin", shown)
+            self.assertNotIn("---BEGIN_", shown)
+            self.assertNotIn("---END_", shown)
+
+    def test_unterminated_block_is_hidden_and_flagged(self):
+        reply = "Thanks.\n" + CLINICAL[:-len("---END_CLINICAL_SUMMARY_CONFIDENTIAL---")]
+        shown, sentinel_filter = run_filter([reply])
+        self.assertEqual(shown.strip(), "Thanks.")
+        self.assertTrue(sentinel_filter.truncated)
+        self.assertEqual(sentinel_filter.result(), ("Thanks.", "", ""))
+
+def message(role, content):
+    return {"role": role, "content": content}
+
+class MessagesOverBudgetTest(unittest.TestCase):
+    def test_nothing_dropped_within_budget(self):
+        messages = [message("user", "hi"), message("assistant", "hello")]
+        self.assertEqual(messages_over_budget(messages, len(format_conversation(messages))), 0)
+
+    def test_drops_whole_messages_oldest_first(self):
+        messages = [
+            message("user", "a" * 50),
+            message("assistant", "b" * 50),
+            message("user", "c" * 10),
+            message("assistant", "d" * 10),
+        ]
+        budget = len(format_conversation(messages[2:]))
+        dropped = messages_over_budget(messages, budget)
+        self.assertEqual(dropped, 2)
+        self.assertLessEqual(len(format_conversation(messages[dropped:])), budget)
+        self.assertEqual(messages_over_budget(messages, budget - 1), 3)
+
+    def test_current_turn_is_never_dropped(self):
+        messages = [message("assistant", "question"), message("user", "x" * 500)]
+        self.assertEqual(messages_over_budget(messages, 100), 1)
+        self.assertEqual(messages_over_budget(messages[1:], 100), 0)
+        self.assertEqual(messages_over_budget([], 100), 0)
+
+if __name__ == "__main__":
+    unittest.main()